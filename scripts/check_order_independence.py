@@ -6,6 +6,10 @@ Order-independence test for the trace merge.
 
 Runs merge in original order and in multiple random shuffled orders.
 Asserts outputs are exactly identical (L2 integer log-odds + L3 histogram vote).
+
+The reference is the CLI merge path (merge_packets). Payloads are then
+decoded once up front; each shuffle only draws a permutation of the decoded
+packets and re-runs the accumulation in that order.
 """
 
 import argparse
@@ -20,7 +24,7 @@ THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 if THIS_DIR not in sys.path:
     sys.path.insert(0, THIS_DIR)
 
-from merge_demo import load_trace, merge_packets  # noqa: E402
+from merge_demo import decode_packets, load_trace, merge_decoded, merge_packets  # noqa: E402
 
 
 def main():
@@ -37,11 +41,11 @@ def main():
     ref_sem = ref["sem_label"].copy()
     ref_occ = ref["occ_bin"].copy()
 
+    decoded = decode_packets(packets)
     rng = np.random.RandomState(args.seed)
     for i in range(args.n_shuffles):
-        pk = list(packets)
-        rng.shuffle(pk)
-        out = merge_packets(header, pk)
+        perm = rng.permutation(len(decoded))
+        out = merge_decoded(header, decoded, order=perm)
 
         if not np.array_equal(out["Lq"], ref_Lq):
             raise RuntimeError(f"Mismatch in Lq at shuffle {i}")
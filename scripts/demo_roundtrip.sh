@@ -20,4 +20,17 @@ python scripts/check_order_independence.py --trace "${TRACE}" --n_shuffles 20 --
 # 4) Merge once and export a tiny artifact
 python scripts/merge_demo.py --trace "${TRACE}" --out_npz out/merged_demo.npz
 
+# 5) Sharded parallel merge must match the serial merge bit for bit
+python scripts/merge_demo.py --trace "${TRACE}" --workers 2 --out_npz out/merged_demo_w2.npz
+python - <<'PY'
+import numpy as np
+
+a = np.load("out/merged_demo.npz")
+b = np.load("out/merged_demo_w2.npz")
+for k in ("Lq", "sem_label", "occ_bin"):
+    if a[k].dtype != b[k].dtype or not np.array_equal(a[k], b[k]):
+        raise SystemExit(f"[FAIL] --workers 2 merge differs in {k}")
+print("[OK] parallel merge matches serial merge.")
+PY
+
 echo "[OK] demo roundtrip finished."
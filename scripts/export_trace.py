@@ -9,6 +9,10 @@ Each line is one JSON object:
   - packet: {type:"packet", submap_id, robot_id, layer, version, stamp, payload, crc}
 
 CRC is computed over canonical JSON of the object WITHOUT the 'crc' field.
+
+With --format msgpack the same objects are written as a stream of msgpack
+records instead; array payloads then carry raw compressed bytes (codec "z" or
+"zstd", no base64) and CRC is computed over canonical msgpack (sorted keys).
 """
 
 import argparse
@@ -17,33 +21,81 @@ import json
 import os
 import time
 import zlib
-from typing import Any, Dict, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 
+try:  # ISA-L CRC32 (PCLMULQDQ); same zlib polynomial, so CRCs are unchanged
+    from isal.isal_zlib import crc32
+except ImportError:  # pragma: no cover
+    from zlib import crc32
+
+try:  # optional: only needed for --codec b64zstd
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:  # optional: only needed for --format msgpack
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+CODECS = ("b64z", "b64zstd")
+BINARY_CODECS = ("z", "zstd")
+
+# One compressor reused for every array (payloads are a few hundred bytes, so
+# per-call context setup would dominate).
+_ZSTD_COMPRESSOR = zstandard.ZstdCompressor(level=3) if zstandard is not None else None
+
 
 def canonical_json_bytes(obj: Dict[str, Any]) -> bytes:
     # stable: sorted keys, no spaces
     return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
 
 
-def attach_crc(obj_wo_crc: Dict[str, Any]) -> Dict[str, Any]:
-    b = canonical_json_bytes(obj_wo_crc)
-    crc = zlib.crc32(b) & 0xFFFFFFFF
-    out = dict(obj_wo_crc)
-    out["crc"] = int(crc)
-    return out
+def _sorted_keys(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return {k: _sorted_keys(obj[k]) for k in sorted(obj)}
+    if isinstance(obj, list):
+        return [_sorted_keys(v) for v in obj]
+    return obj
 
 
-def b64z_pack_ndarray(arr: np.ndarray) -> Dict[str, Any]:
-    arr = np.ascontiguousarray(arr)
-    raw = arr.tobytes(order="C")
-    comp = zlib.compress(raw, level=6)
-    b64 = base64.b64encode(comp).decode("ascii")
-    return {"codec": "b64z", "dtype": str(arr.dtype), "shape": list(arr.shape), "data": b64}
+def canonical_msgpack_bytes(obj: Dict[str, Any]) -> bytes:
+    # stable: recursively sorted keys, bin type for raw payload bytes
+    if msgpack is None:
+        raise RuntimeError("msgpack traces require the 'msgpack' package")
+    return msgpack.packb(_sorted_keys(obj), use_bin_type=True)
 
 
-def make_header(n_vox: int, lmax_q: int, q_scale: int, n_classes: int) -> Dict[str, Any]:
+def seal_crc(obj_wo_crc: Dict[str, Any], binary: bool = False) -> Dict[str, Any]:
+    # In-place variant of attach_crc for freshly built objects (no dict copy).
+    b = canonical_msgpack_bytes(obj_wo_crc) if binary else canonical_json_bytes(obj_wo_crc)
+    obj_wo_crc["crc"] = int(crc32(b) & 0xFFFFFFFF)
+    return obj_wo_crc
+
+
+def attach_crc(obj_wo_crc: Dict[str, Any], binary: bool = False) -> Dict[str, Any]:
+    return seal_crc(dict(obj_wo_crc), binary)
+
+
+def b64z_pack_ndarray(arr: np.ndarray, codec: str = "b64z") -> Dict[str, Any]:
+    arr = np.ascontiguousarray(arr)
+    raw = arr.tobytes(order="C")
+    if codec in ("b64z", "z"):
+        comp = zlib.compress(raw, level=6)
+    elif codec in ("b64zstd", "zstd"):
+        if _ZSTD_COMPRESSOR is None:
+            raise RuntimeError(f"codec '{codec}' requires the 'zstandard' package")
+        comp = _ZSTD_COMPRESSOR.compress(raw)
+    else:
+        raise ValueError(f"Unsupported codec '{codec}' (expected one of {CODECS + BINARY_CODECS})")
+    data = comp if codec in BINARY_CODECS else base64.b64encode(comp).decode("ascii")
+    return {"codec": codec, "dtype": str(arr.dtype), "shape": list(arr.shape), "data": data}
+
+
+def make_header(n_vox: int, lmax_q: int, q_scale: int, n_classes: int, binary: bool = False) -> Dict[str, Any]:
     hdr = {
         "type": "header",
         "format_version": "0.1.0",
@@ -53,7 +105,7 @@ def make_header(n_vox: int, lmax_q: int, q_scale: int, n_classes: int) -> Dict[s
         "n_classes": int(n_classes),
         "note": "Dataset-free demo trace for prefix-decodable / order-independent fusion checks.",
     }
-    return attach_crc(hdr)
+    return seal_crc(hdr, binary)
 
 
 def make_packet(
@@ -63,6 +115,7 @@ def make_packet(
     version: int,
     stamp: int,
     payload: Dict[str, Any],
+    binary: bool = False,
 ) -> Dict[str, Any]:
     pkt = {
         "type": "packet",
@@ -73,7 +126,77 @@ def make_packet(
         "stamp": int(stamp),
         "payload": payload,
     }
-    return attach_crc(pkt)
+    return seal_crc(pkt, binary)
+
+
+# Packets per chunk when --workers is given. Each chunk draws from its own
+# RandomState([seed, chunk_start]), so output depends only on the seed, not on
+# how many workers the chunks end up running on.
+SYNTH_CHUNK = 256
+
+
+def _synth_packet(
+    rng: np.random.RandomState,
+    t: int,
+    stamp0: int,
+    hot: np.ndarray,
+    n_vox: int,
+    n_classes: int,
+    codec: str,
+) -> Dict[str, Any]:
+    binary = codec in BINARY_CODECS
+    version = t + 1
+    stamp = stamp0 + t
+
+    robot_id = int(rng.randint(0, 2))
+    submap_id = int(rng.randint(0, 4))
+
+    # occasionally emit L1 skeleton/meta
+    if t % 20 == 0:
+        payload = {"kind": "L1_skeleton", "text": f"demo backbone update v{version}"}
+        return make_packet(submap_id, robot_id, 1, version, stamp, payload, binary)
+
+    layer = 2 if (t % 3 != 0) else 3
+
+    n_upd = int(rng.randint(80, 200))
+    idx_hot = rng.choice(hot, size=n_upd // 2, replace=True)
+    idx_rnd = rng.randint(0, n_vox, size=n_upd - idx_hot.size)
+    idx = np.concatenate([idx_hot, idx_rnd]).astype(np.int32)
+
+    if layer == 2:
+        # integer quantized log-odds delta => exact commutative merge
+        hit = rng.rand(idx.size) < 0.7
+        delta = np.where(hit, rng.randint(30, 120, size=idx.size), -rng.randint(5, 30, size=idx.size))
+        delta_q = np.clip(delta, -32768, 32767).astype(np.int16)
+
+        payload = {
+            "kind": "L2_occ_delta",
+            "indices": b64z_pack_ndarray(idx, codec),
+            "delta_q": b64z_pack_ndarray(delta_q, codec),
+        }
+        return make_packet(submap_id, robot_id, 2, version, stamp, payload, binary)
+
+    cls = rng.randint(0, n_classes, size=idx.size).astype(np.uint16)
+    payload = {
+        "kind": "L3_sem_delta",
+        "indices": b64z_pack_ndarray(idx, codec),
+        "sem": b64z_pack_ndarray(cls, codec),
+    }
+    return make_packet(submap_id, robot_id, 3, version, stamp, payload, binary)
+
+
+def _synth_chunk(
+    start: int,
+    end: int,
+    seed: int,
+    stamp0: int,
+    hot: np.ndarray,
+    n_vox: int,
+    n_classes: int,
+    codec: str,
+) -> List[Dict[str, Any]]:
+    rng = np.random.RandomState([seed, start])
+    return [_synth_packet(rng, t, stamp0, hot, n_vox, n_classes, codec) for t in range(start, end)]
 
 
 def generate_synth_trace(
@@ -83,73 +206,71 @@ def generate_synth_trace(
     q_scale: int,
     lmax_float: float,
     n_classes: int,
+    codec: str = "b64z",
+    workers: Optional[int] = None,
 ) -> List[Dict[str, Any]]:
     rng = np.random.RandomState(seed)
     lmax_q = int(round(lmax_float * q_scale))
+    binary = codec in BINARY_CODECS
 
     trace: List[Dict[str, Any]] = []
-    trace.append(make_header(n_vox=n_vox, lmax_q=lmax_q, q_scale=q_scale, n_classes=n_classes))
+    trace.append(make_header(n_vox=n_vox, lmax_q=lmax_q, q_scale=q_scale, n_classes=n_classes, binary=binary))
 
-    version = 0
     stamp0 = int(time.time() * 1000)
 
     hot = rng.choice(n_vox, size=max(200, n_vox // 50), replace=False)
 
-    for t in range(n_packets):
-        version += 1
-        stamp = stamp0 + t
-
-        robot_id = int(rng.randint(0, 2))
-        submap_id = int(rng.randint(0, 4))
-
-        # occasionally emit L1 skeleton/meta
-        if t % 20 == 0:
-            payload = {"kind": "L1_skeleton", "text": f"demo backbone update v{version}"}
-            trace.append(make_packet(submap_id, robot_id, 1, version, stamp, payload))
-            continue
-
-        layer = 2 if (t % 3 != 0) else 3
-
-        n_upd = int(rng.randint(80, 200))
-        idx_hot = rng.choice(hot, size=n_upd // 2, replace=True)
-        idx_rnd = rng.randint(0, n_vox, size=n_upd - idx_hot.size)
-        idx = np.concatenate([idx_hot, idx_rnd]).astype(np.int32)
-
-        if layer == 2:
-            # integer quantized log-odds delta => exact commutative merge
-            hit = rng.rand(idx.size) < 0.7
-            delta = np.where(hit, rng.randint(30, 120, size=idx.size), -rng.randint(5, 30, size=idx.size))
-            delta_q = np.clip(delta, -32768, 32767).astype(np.int16)
-
-            payload = {
-                "kind": "L2_occ_delta",
-                "indices": b64z_pack_ndarray(idx),
-                "delta_q": b64z_pack_ndarray(delta_q),
-            }
-            trace.append(make_packet(submap_id, robot_id, 2, version, stamp, payload))
-        else:
-            cls = rng.randint(0, n_classes, size=idx.size).astype(np.uint16)
-            payload = {
-                "kind": "L3_sem_delta",
-                "indices": b64z_pack_ndarray(idx),
-                "sem": b64z_pack_ndarray(cls),
-            }
-            trace.append(make_packet(submap_id, robot_id, 3, version, stamp, payload))
+    if workers is None:
+        # single RNG stream (the original serial trace for a given seed)
+        for t in range(n_packets):
+            trace.append(_synth_packet(rng, t, stamp0, hot, n_vox, n_classes, codec))
+        return trace
+
+    # per-chunk RNG streams: the same trace whether chunks run here or in a pool
+    chunks = [(s, min(s + SYNTH_CHUNK, n_packets)) for s in range(0, n_packets, SYNTH_CHUNK)]
+    if workers <= 1:
+        for start, end in chunks:
+            trace.extend(_synth_chunk(start, end, seed, stamp0, hot, n_vox, n_classes, codec))
+        return trace
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_synth_chunk, start, end, seed, stamp0, hot, n_vox, n_classes, codec)
+            for start, end in chunks
+        ]
+        for fut in futures:  # submission order keeps the trace ordered
+            trace.extend(fut.result())
 
     return trace
 
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--out", default="trace/trace_demo.jsonl")
+    ap.add_argument("--out", default=None, help="default: trace/trace_demo.jsonl (or .msgpack)")
     ap.add_argument("--n_vox", type=int, default=20000)
     ap.add_argument("--n_packets", type=int, default=200)
     ap.add_argument("--seed", type=int, default=0)
     ap.add_argument("--q_scale", type=int, default=100)
     ap.add_argument("--lmax", type=float, default=6.0)
     ap.add_argument("--n_classes", type=int, default=20)
+    ap.add_argument("--codec", choices=CODECS, default="b64z")
+    ap.add_argument("--format", choices=("jsonl", "msgpack"), default="jsonl")
+    ap.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="generate in per-chunk RNG streams on N worker processes (0 = os.cpu_count()); "
+        "the trace depends only on --seed, but differs from the default single-stream trace",
+    )
     args = ap.parse_args()
 
+    # readers pick the container from the suffix, so it must match --format
+    ext = ".msgpack" if args.format == "msgpack" else ".jsonl"
+    if args.out is None:
+        args.out = "trace/trace_demo" + ext
+    elif args.out.endswith(".msgpack") != (args.format == "msgpack"):
+        ap.error(f"--out '{args.out}': only --format msgpack traces may (and must) end in '.msgpack'")
+
     os.makedirs(os.path.dirname(args.out), exist_ok=True)
     trace = generate_synth_trace(
         n_vox=args.n_vox,
@@ -158,11 +279,19 @@ def main():
         q_scale=args.q_scale,
         lmax_float=args.lmax,
         n_classes=args.n_classes,
+        # msgpack stores bytes natively, so drop the base64 framing
+        codec=args.codec if args.format == "jsonl" else args.codec[len("b64"):],
+        workers=None if args.workers is None else (args.workers or os.cpu_count() or 1),
     )
 
-    with open(args.out, "w", encoding="utf-8") as f:
-        for obj in trace:
-            f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    if args.format == "msgpack":
+        with open(args.out, "wb") as f:
+            for obj in trace:
+                f.write(msgpack.packb(obj, use_bin_type=True))
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for obj in trace:
+                f.write(json.dumps(obj, ensure_ascii=False) + "\n")
 
     print(f"[OK] wrote {len(trace)} lines -> {args.out}")
 
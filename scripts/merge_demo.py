@@ -4,9 +4,14 @@
 """
 Merge packets in a trace using commutative/associative rules:
 
-- L2: accumulate quantized log-odds deltas with exact integer addition (np.add.at),
-      then apply ONE final clamp at the end.
-- L3: per-voxel class histogram vote via np.add.at (commutative).
+- L2: accumulate quantized log-odds deltas with exact integer addition (np.bincount
+      over all L2 indices), then apply ONE final clamp at the end.
+- L3: per-voxel class histogram vote via np.bincount on flattened
+      (voxel, class) bins (commutative).
+
+When numba is installed and the trace is large, the L2 accumulation runs in a
+JIT-compiled kernel with per-thread partial buffers that are summed at the
+end, so the result stays exactly order-independent.
 
 This design ensures order-independence under packet shuffling.
 """
@@ -14,101 +19,448 @@ This design ensures order-independence under packet shuffling.
 import argparse
 import base64
 import json
+import mmap
 import os
 import zlib
-from typing import Any, Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
 
 import numpy as np
 
+try:  # faster (Rust/SIMD) JSON; stdlib json is the fallback
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:  # optional: only needed to decode "b64zstd"/"zstd" containers
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:  # optional: only needed for .msgpack traces
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:  # optional: only needed for --device cuda
+    import cupy as cp
+    import cupyx
+except ImportError:  # pragma: no cover
+    cp = None
+
+# One decompressor reused for every container; per-call context setup would
+# dominate for arrays of a few hundred bytes.
+_ZSTD_DECOMPRESSOR = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+
+# Below this many L2 entries np.bincount wins once numba's import and
+# kernel-cache load are counted, so the JIT path is only taken for big traces.
+NUMBA_MIN_L2_ENTRIES = 1 << 25
+
+_accum_l2_kernel = None
+
+# Upper bound on the dense L3 vote grid (int64 bins, i.e. 8 MB) per block.
+L3_BLOCK_BINS = 1 << 20
+
+
+def _numba_accum_l2():
+    """Build (or load from cache) the numba L2 kernel; None without numba."""
+    global _accum_l2_kernel
+    if _accum_l2_kernel is None:
+        try:  # optional JIT backend; imported lazily so small merges skip it
+            from numba import get_num_threads, njit, prange
+        except ImportError:  # pragma: no cover
+            _accum_l2_kernel = False
+            return None
+
+        @njit(nogil=True, cache=True, parallel=True)
+        def _accum_l2(Lq_raw, idx, delta_q, n_chunks):
+            # Per-thread partial buffers, summed at the end (integer add => exact).
+            n = idx.shape[0]
+            step = (n + n_chunks - 1) // n_chunks
+            local = np.zeros((n_chunks, Lq_raw.shape[0]), dtype=np.int64)
+            for c in prange(n_chunks):
+                for i in range(c * step, min(n, (c + 1) * step)):
+                    local[c, idx[i]] += delta_q[i]
+            for c in range(n_chunks):
+                Lq_raw += local[c]
+
+        def run(Lq_raw, idx, delta_q):
+            # Cap the partial buffers at roughly the size of the input itself.
+            n_chunks = max(1, min(get_num_threads(), idx.size // Lq_raw.size))
+            _accum_l2(Lq_raw, idx, delta_q, n_chunks)
+
+        _accum_l2_kernel = run
+    return _accum_l2_kernel or None
+
 
 def b64z_unpack_ndarray(obj: Dict[str, Any]) -> np.ndarray:
-    if obj.get("codec") != "b64z":
-        raise ValueError("Unsupported codec (expected b64z)")
+    codec = obj.get("codec")
     dtype = np.dtype(obj["dtype"])
     shape = tuple(obj["shape"])
-    raw = zlib.decompress(base64.b64decode(obj["data"].encode("ascii")))
+    if codec in ("b64z", "b64zstd"):
+        comp = base64.b64decode(obj["data"].encode("ascii"))
+    else:
+        comp = obj["data"]  # binary containers (msgpack traces) carry raw bytes
+    if codec in ("b64z", "z"):
+        raw = zlib.decompress(comp)
+    elif codec in ("b64zstd", "zstd"):
+        if _ZSTD_DECOMPRESSOR is None:
+            raise RuntimeError(f"codec '{codec}' requires the 'zstandard' package")
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        raw = _ZSTD_DECOMPRESSOR.decompress(comp, max_output_size=nbytes)
+    else:
+        raise ValueError(f"Unsupported codec '{codec}' (expected b64z, b64zstd, z or zstd)")
     return np.frombuffer(raw, dtype=dtype).reshape(shape)
 
 
-def load_trace(trace_path: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+def iter_trace(trace_path: str) -> Iterator[Dict[str, Any]]:
+    """Yield trace objects from a JSONL or (by extension) .msgpack trace."""
+    if trace_path.endswith(".msgpack"):
+        if msgpack is None:
+            raise RuntimeError("msgpack traces require the 'msgpack' package")
+        with open(trace_path, "rb") as f:
+            yield from msgpack.Unpacker(f, raw=False)
+        return
+    with open(trace_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from _iter_jsonl(mm, 0, len(mm))
+
+
+def _loads(line: bytes) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN/Infinity tokens, which stdlib json accepts
+    return json.loads(line)
+
+
+def _iter_jsonl(mm: mmap.mmap, start: int, end: int) -> Iterator[Dict[str, Any]]:
+    # Scan the mapped file for newlines (memchr) instead of buffered readline.
+    while start < end:
+        stop = mm.find(b"\n", start, end)
+        if stop < 0:
+            stop = end
+        line = mm[start:stop].strip()
+        start = stop + 1
+        if line:
+            yield _loads(line)
+
+
+def _split_objects(objs: Iterator[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
     header = None
     packets: List[Dict[str, Any]] = []
-    with open(trace_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            obj = json.loads(line)
-            if obj.get("type") == "header":
-                header = obj
-            elif obj.get("type") == "packet":
-                packets.append(obj)
+    for obj in objs:
+        if obj.get("type") == "header":
+            header = obj
+        elif obj.get("type") == "packet":
+            packets.append(obj)
+    return header, packets
+
+
+def load_trace(trace_path: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    header, packets = _split_objects(iter_trace(trace_path))
     if header is None:
         raise RuntimeError("Missing header in trace")
     return header, packets
 
 
-def merge_packets(header: Dict[str, Any], packets: List[Dict[str, Any]]) -> Dict[str, Any]:
-    n_vox = int(header["n_vox"])
-    lmax_q = int(header["lmax_q"])
-    n_classes = int(header["n_classes"])
+# Payload key holding the per-index values, by payload kind.
+_VALUE_KEY = {"L2_occ_delta": "delta_q", "L3_sem_delta": "sem"}
 
-    # Raw accumulator (unclamped) -> order-independent
-    Lq_raw = np.zeros(n_vox, dtype=np.int32)
 
-    # Semantic vote counts
-    sem_cnt = np.zeros((n_vox, n_classes), dtype=np.uint16)
+def _packet_kind(pkt: Dict[str, Any]) -> str:
+    # L1 carries no array payload and is skipped by the merge.
+    if int(pkt["layer"]) == 1:
+        return ""
+    return pkt["payload"].get("kind", "")
 
+
+class DecodedPacket(NamedTuple):
+    kind: str
+    indices: np.ndarray
+    values: np.ndarray  # delta_q for L2_occ_delta, class ids for L3_sem_delta
+
+
+def decode_packets(packets: List[Dict[str, Any]]) -> List[DecodedPacket]:
+    """Decode L2/L3 array payloads once; L1 and unknown kinds are dropped."""
+    decoded: List[DecodedPacket] = []
     for pkt in packets:
-        layer = int(pkt["layer"])
+        kind = _packet_kind(pkt)
+        key = _VALUE_KEY.get(kind)
+        if key is None:
+            continue
+
         payload = pkt["payload"]
-        kind = payload.get("kind", "")
+        decoded.append(
+            DecodedPacket(kind, b64z_unpack_ndarray(payload["indices"]), b64z_unpack_ndarray(payload[key]))
+        )
+    return decoded
 
-        if layer == 1:
-            continue
 
-        if kind == "L2_occ_delta":
-            idx = b64z_unpack_ndarray(payload["indices"]).astype(np.int64)
-            delta_q = b64z_unpack_ndarray(payload["delta_q"]).astype(np.int32)
+def b64z_unpack_into(obj: Dict[str, Any], out: np.ndarray) -> None:
+    """Decode a container straight into a preallocated (flat) slice."""
+    np.copyto(out, b64z_unpack_ndarray(obj).reshape(out.shape), casting="same_kind")
 
-            # IMPORTANT: use add.at to correctly handle repeated indices
-            np.add.at(Lq_raw, idx, delta_q)
 
-        elif kind == "L3_sem_delta":
-            idx = b64z_unpack_ndarray(payload["indices"]).astype(np.int64)
-            sem = b64z_unpack_ndarray(payload["sem"]).astype(np.int64)
-            sem = np.clip(sem, 0, n_classes - 1)
+def _int_result_type(dtypes: Sequence[np.dtype]) -> np.dtype:
+    # Common dtype of per-packet integer arrays. Mixing int64 with uint64
+    # promotes to float64, which np.bincount rejects, so fall back to intp.
+    dtype = np.result_type(*dtypes) if dtypes else np.dtype(np.int64)
+    return dtype if dtype.kind in "iu" else np.dtype(np.intp)
 
-            # IMPORTANT: use add.at for repeated (idx, sem) pairs
-            np.add.at(sem_cnt, (idx, sem), 1)
 
-        else:
-            continue
+def _unpack_concat(objs: List[Dict[str, Any]]) -> np.ndarray:
+    # Pass 1 sizes the flat buffer from container metadata alone;
+    # pass 2 decodes each container into its slice.
+    sizes = [int(np.prod(o["shape"], dtype=np.int64)) for o in objs]
+    out = np.empty(sum(sizes), dtype=_int_result_type([np.dtype(o["dtype"]) for o in objs]))
+    off = 0
+    for obj, n in zip(objs, sizes):
+        b64z_unpack_into(obj, out[off:off + n])
+        off += n
+    return out
+
+
+def _flat_arrays(packets: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # (L2 indices, L2 deltas, L3 indices, L3 class ids) over all packets
+    by_kind: Dict[str, List[Dict[str, Any]]] = {kind: [] for kind in _VALUE_KEY}
+    for pkt in packets:
+        group = by_kind.get(_packet_kind(pkt))
+        if group is not None:
+            group.append(pkt["payload"])
+    l2, l3 = by_kind["L2_occ_delta"], by_kind["L3_sem_delta"]
+    return (
+        _unpack_concat([p["indices"] for p in l2]),
+        _unpack_concat([p["delta_q"] for p in l2]),
+        _unpack_concat([p["indices"] for p in l3]),
+        _unpack_concat([p["sem"] for p in l3]),
+    )
+
+
+def merge_packets(header: Dict[str, Any], packets: List[Dict[str, Any]], device: str = "cpu") -> Dict[str, Any]:
+    return _accumulate(header, *_flat_arrays(packets), device)
+
+
+def _decode_shard(trace_path: str, start: int, end: int) -> Tuple[Optional[Dict[str, Any]], Tuple[np.ndarray, ...]]:
+    with open(trace_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header, packets = _split_objects(_iter_jsonl(mm, start, end))
+    return header, _flat_arrays(packets)
+
+
+def merge_trace_parallel(trace_path: str, workers: int, device: str = "cpu") -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Parse and decode line-aligned byte shards of a JSONL trace in worker
+    processes, then reduce once. Fusion is commutative, so the result is
+    identical to merge_packets on the whole trace."""
+    with open(trace_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        bounds = [0]
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for k in range(1, workers):
+                    nl = mm.find(b"\n", max(k * size // workers, bounds[-1]))
+                    if nl < 0:
+                        break
+                    bounds.append(nl + 1)
+        bounds.append(size)
+    shards = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_decode_shard, [trace_path] * len(shards), *zip(*shards)))
+
+    # like load_trace, the last header in file order wins
+    headers = [h for h, _ in results if h is not None]
+    if not headers:
+        raise RuntimeError("Missing header in trace")
+    flat = [_concat([r[1][i] for r in results if r[1][i].size]) for i in range(4)]
+    return headers[-1], _accumulate(headers[-1], *flat, device)
+
+
+def _concat(arrs: List[np.ndarray]) -> np.ndarray:
+    if not arrs:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(arrs, dtype=_int_result_type([a.dtype for a in arrs]))
+
+
+def merge_decoded(
+    header: Dict[str, Any],
+    decoded: List[DecodedPacket],
+    device: str = "cpu",
+    order: Optional[Sequence[int]] = None,
+) -> Dict[str, Any]:
+    # `order` applies packets in a permuted order without building a shuffled copy.
+    if order is None:
+        order = range(len(decoded))
+    l2 = [decoded[i] for i in order if decoded[i].kind == "L2_occ_delta"]
+    l3 = [decoded[i] for i in order if decoded[i].kind == "L3_sem_delta"]
+    return _accumulate(
+        header,
+        _concat([d.indices for d in l2]),
+        _concat([d.values for d in l2]),
+        _concat([d.indices for d in l3]),
+        _concat([d.values for d in l3]),
+        device,
+    )
+
+
+def _accumulate(
+    header: Dict[str, Any],
+    l2_idx: np.ndarray,
+    l2_delta: np.ndarray,
+    l3_idx: np.ndarray,
+    l3_sem: np.ndarray,
+    device: str = "cpu",
+) -> Dict[str, Any]:
+    # Flat (SoA) arrays over the whole trace, kept in their wire dtypes.
+    n_vox = int(header["n_vox"])
+    lmax_q = int(header["lmax_q"])
+    n_classes = int(header["n_classes"])
+
+    # Out-of-range indices must fail loudly on every backend (the JIT and CUDA
+    # scatters would otherwise write out of bounds or drop them silently).
+    for name, idx in (("L2", l2_idx), ("L3", l3_idx)):
+        if idx.size and (int(idx.min()) < 0 or int(idx.max()) >= n_vox):
+            raise IndexError(f"{name} voxel index out of range [0, {n_vox})")
+
+    if device == "cuda":
+        Lq_raw, sem_label = _accumulate_cuda(n_vox, n_classes, l2_idx, l2_delta, l3_idx, l3_sem)
+    else:
+        Lq_raw, sem_label = _accumulate_cpu(n_vox, n_classes, l2_idx, l2_delta, l3_idx, l3_sem)
 
     # ONE final clamp => commutative/associative overall
     Lq = np.clip(Lq_raw, -lmax_q, lmax_q).astype(np.int32)
 
-    sem_label = sem_cnt.argmax(axis=1).astype(np.uint16)
+    sem_label = sem_label.astype(np.uint16)
     occ_bin = (Lq > 0).astype(np.uint8)
 
     return {"Lq": Lq, "sem_label": sem_label, "occ_bin": occ_bin}
 
 
+def _accumulate_cpu(
+    n_vox: int,
+    n_classes: int,
+    l2_idx: np.ndarray,
+    l2_delta: np.ndarray,
+    l3_idx: np.ndarray,
+    l3_sem: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Raw accumulator (unclamped) -> order-independent
+    Lq_raw = np.zeros(n_vox, dtype=np.int64)
+    if l2_idx.size:
+        accum_l2 = _numba_accum_l2() if l2_idx.size >= NUMBA_MIN_L2_ENTRIES else None
+        if accum_l2 is not None:
+            accum_l2(Lq_raw, l2_idx, l2_delta)
+        else:
+            # bincount sums repeated indices exactly (integer-valued float64 weights)
+            Lq_raw += np.rint(np.bincount(l2_idx, weights=l2_delta, minlength=n_vox)).astype(np.int64)
+
+    # Semantic vote counts -> per-voxel argmax label
+    if not l3_idx.size:
+        return Lq_raw, np.zeros(n_vox, dtype=np.int64)
+
+    # (voxel, class) pair flattened into one bin index. int32 keys (when they
+    # fit) halve the bytes np.unique sorts; np.bincount converts its input to
+    # intp with an extra copy, so the dense branch builds intp keys directly.
+    n_bins = n_vox * n_classes
+    sparse = l3_idx.size * 10 < n_bins
+    key_dtype = np.int32 if sparse and n_bins <= np.iinfo(np.int32).max else np.intp
+    flat = l3_idx.astype(key_dtype)
+    flat *= n_classes
+    flat += np.clip(l3_sem, 0, n_classes - 1)  # in-place add casts; no key-sized temp
+    if sparse:
+        # Sparse votes: sort + run-length count, and take the argmax over the
+        # (voxel, class) keys present instead of a dense n_vox x n_classes grid.
+        bins, counts = np.unique(flat, return_counts=True)
+        return Lq_raw, _sparse_argmax(bins, counts, n_vox, n_classes)
+    return Lq_raw, _blocked_argmax(flat, n_vox, n_classes)
+
+
+def _blocked_argmax(flat: np.ndarray, n_vox: int, n_classes: int) -> np.ndarray:
+    # Dense votes: bincount one block of voxels at a time so the int64 count
+    # grid never exceeds L3_BLOCK_BINS bins, however large n_vox * n_classes is.
+    # `flat` (intp keys, owned by the caller) is sorted and rebased in place.
+    block = max(1, L3_BLOCK_BINS // n_classes)
+    if n_vox <= block:
+        return np.bincount(flat, minlength=n_vox * n_classes).reshape(n_vox, n_classes).argmax(axis=1)
+
+    flat.sort()
+    starts = np.arange(0, n_vox, block)
+    cuts = np.searchsorted(flat, np.append(starts, n_vox) * n_classes)
+    label = np.empty(n_vox, dtype=np.int64)
+    for k, v0 in enumerate(starts):
+        v1 = min(v0 + block, n_vox)
+        keys = flat[cuts[k]:cuts[k + 1]]
+        keys -= v0 * n_classes
+        cnt = np.bincount(keys, minlength=(v1 - v0) * n_classes)
+        label[v0:v1] = cnt.reshape(v1 - v0, n_classes).argmax(axis=1)
+    return label
+
+
+def _sparse_argmax(bins: np.ndarray, counts: np.ndarray, n_vox: int, n_classes: int) -> np.ndarray:
+    # Same result as a dense argmax: highest count wins, lowest class id on
+    # ties, and voxels without votes get label 0.
+    vox, cls = np.divmod(bins, n_classes)
+    order = np.lexsort((cls, -counts, vox))
+    vox, cls = vox[order], cls[order]
+    first = np.ones(vox.size, dtype=bool)
+    first[1:] = vox[1:] != vox[:-1]
+    label = np.zeros(n_vox, dtype=np.int64)
+    label[vox[first]] = cls[first]
+    return label
+
+
+def _accumulate_cuda(
+    n_vox: int,
+    n_classes: int,
+    l2_idx: np.ndarray,
+    l2_delta: np.ndarray,
+    l3_idx: np.ndarray,
+    l3_sem: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Integer atomicAdd on the device is exact, so the result is still
+    # order-independent; only the votes' argmax is copied back.
+    if cp is None:
+        raise RuntimeError("--device cuda requires the 'cupy' package")
+
+    # 64-bit like the CPU path. atomicAdd has no signed 64-bit overload, so add
+    # the two's-complement bits as uint64 (exact mod 2**64) and view as int64.
+    Lq_d = cp.zeros(n_vox, dtype=cp.uint64)
+    if l2_idx.size:
+        delta = cp.asarray(l2_delta).astype(cp.int64).view(cp.uint64)
+        cupyx.scatter_add(Lq_d, cp.asarray(l2_idx), delta)
+
+    sem_d = cp.zeros((n_vox, n_classes), dtype=cp.int32)
+    if l3_idx.size:
+        sem = cp.clip(cp.asarray(l3_sem), 0, n_classes - 1)
+        cupyx.scatter_add(sem_d, (cp.asarray(l3_idx), sem), cp.ones(l3_idx.size, dtype=cp.int32))
+
+    return Lq_d.view(cp.int64).get(), sem_d.argmax(axis=1).get()
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--trace", required=True)
     ap.add_argument("--shuffle", action="store_true")
     ap.add_argument("--seed", type=int, default=0)
     ap.add_argument("--out_npz", default="out/merged_demo.npz")
+    ap.add_argument("--device", choices=("cpu", "cuda"), default="cpu")
+    ap.add_argument("--workers", type=int, default=1, help="parse/decode JSONL shards in N processes (0 = os.cpu_count())")
     args = ap.parse_args()
 
-    header, packets = load_trace(args.trace)
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and not args.shuffle and not args.trace.endswith(".msgpack"):
+        header, out = merge_trace_parallel(args.trace, workers, device=args.device)
+    else:
+        header, packets = load_trace(args.trace)
 
-    if args.shuffle:
-        rng = np.random.RandomState(args.seed)
-        rng.shuffle(packets)
+        if args.shuffle:
+            rng = np.random.RandomState(args.seed)
+            rng.shuffle(packets)
 
-    out = merge_packets(header, packets)
+        out = merge_packets(header, packets, device=args.device)
 
     os.makedirs(os.path.dirname(args.out_npz), exist_ok=True)
     np.savez_compressed(
@@ -6,58 +6,126 @@ Validate a JSONL trace:
 - each line is valid JSON
 - required keys exist
 - crc matches canonical JSON of the object without 'crc'
+
+.msgpack traces (see export_trace.py --format msgpack) are accepted too; their
+crc is checked against canonical msgpack instead of canonical JSON.
 """
 
 import argparse
 import json
-import zlib
-from typing import Any, Dict
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, Tuple
+
+try:  # ISA-L CRC32 (PCLMULQDQ); same zlib polynomial, so CRCs are unchanged
+    from isal.isal_zlib import crc32
+except ImportError:  # pragma: no cover
+    from zlib import crc32
+
+try:  # optional: only needed for .msgpack traces
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 
 def canonical_json_bytes(obj: Dict[str, Any]) -> bytes:
+    # CRCs are defined over this exact stdlib form (float repr, NaN, big ints),
+    # so it must not depend on optional JSON packages.
     return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
 
 
+def _sorted_keys(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return {k: _sorted_keys(obj[k]) for k in sorted(obj)}
+    if isinstance(obj, list):
+        return [_sorted_keys(v) for v in obj]
+    return obj
+
+
+def canonical_msgpack_bytes(obj: Dict[str, Any]) -> bytes:
+    return msgpack.packb(_sorted_keys(obj), use_bin_type=True)
+
+
+def iter_records(path: str) -> Iterator[Tuple[int, Any]]:
+    """Yield (1-based record number, object or None for blank lines)."""
+    if path.endswith(".msgpack"):
+        if msgpack is None:
+            raise RuntimeError("msgpack traces require the 'msgpack' package")
+        with open(path, "rb") as f:
+            for n, obj in enumerate(msgpack.Unpacker(f, raw=False), start=1):
+                yield n, obj
+        return
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for n, line in enumerate(iter(mm.readline, b""), start=1):
+                # json accepts the trailing newline; only blank lines are skipped
+                yield n, (json.loads(line) if not line.isspace() else None)
+
+
+def validate_trace(path: str) -> Tuple[int, int]:
+    """Validate one trace; returns (valid records, total lines/records)."""
+    canonical = canonical_msgpack_bytes if path.endswith(".msgpack") else canonical_json_bytes
+
+    n = 0
+    ok = 0
+    for n, obj in iter_records(path):
+        if obj is None:
+            continue
+
+        if "crc" not in obj:
+            raise RuntimeError(f"Line {n}: missing 'crc'")
+
+        # obj is not reused after validation, so drop 'crc' in place (no dict copy)
+        crc = int(obj.pop("crc"))
+        crc2 = crc32(canonical(obj)) & 0xFFFFFFFF
+        if crc != crc2:
+            raise RuntimeError(f"Line {n}: CRC mismatch: got {crc}, expect {crc2}")
+
+        t = obj.get("type")
+        if t == "header":
+            for k in ["format_version", "n_vox", "lmax_q", "q_scale", "n_classes"]:
+                if k not in obj:
+                    raise RuntimeError(f"Line {n}: header missing key '{k}'")
+        elif t == "packet":
+            for k in ["submap_id", "robot_id", "layer", "version", "stamp", "payload"]:
+                if k not in obj:
+                    raise RuntimeError(f"Line {n}: packet missing key '{k}'")
+        else:
+            raise RuntimeError(f"Line {n}: unknown type '{t}'")
+
+        ok += 1
+
+    return ok, n
+
+
+def _validate_one(path: str) -> Tuple[int, int]:
+    try:
+        return validate_trace(path)
+    except RuntimeError as e:
+        raise RuntimeError(f"{path}: {e}") from None
+
+
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("trace", help="trace JSONL path")
+    ap.add_argument("trace", nargs="+", help="trace JSONL path(s)")
+    ap.add_argument("--workers", type=int, default=1, help="worker processes for multiple traces (0 = os.cpu_count())")
     args = ap.parse_args()
 
-    n = 0
-    ok = 0
-    with open(args.trace, "r", encoding="utf-8") as f:
-        for line in f:
-            n += 1
-            line = line.strip()
-            if not line:
-                continue
-            obj = json.loads(line)
-
-            if "crc" not in obj:
-                raise RuntimeError(f"Line {n}: missing 'crc'")
-
-            crc = int(obj["crc"])
-            obj2 = dict(obj)
-            obj2.pop("crc", None)
-            crc2 = zlib.crc32(canonical_json_bytes(obj2)) & 0xFFFFFFFF
-            if crc != crc2:
-                raise RuntimeError(f"Line {n}: CRC mismatch: got {crc}, expect {crc2}")
-
-            t = obj.get("type")
-            if t == "header":
-                for k in ["format_version", "n_vox", "lmax_q", "q_scale", "n_classes"]:
-                    if k not in obj:
-                        raise RuntimeError(f"Line {n}: header missing key '{k}'")
-            elif t == "packet":
-                for k in ["submap_id", "robot_id", "layer", "version", "stamp", "payload"]:
-                    if k not in obj:
-                        raise RuntimeError(f"Line {n}: packet missing key '{k}'")
-            else:
-                raise RuntimeError(f"Line {n}: unknown type '{t}'")
-
-            ok += 1
-
-    print(f"[OK] validated {ok}/{n} lines: {args.trace}")
+    workers = args.workers or os.cpu_count() or 1
+    if workers <= 1 or len(args.trace) == 1:
+        results = [_validate_one(path) for path in args.trace]
+    else:
+        # traces are independent: validate them in parallel, report in input order;
+        # ~4 batches per worker keeps every worker busy when traces differ in size
+        chunksize = max(1, len(args.trace) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_validate_one, args.trace, chunksize=chunksize))
+
+    for path, (ok, n) in zip(args.trace, results):
+        print(f"[OK] validated {ok}/{n} lines: {path}")
 
 
 if __name__ == "__main__":